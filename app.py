@@ -1,28 +1,110 @@
 # Define get_embeddings at the module level
 
 import os
+import io
+import uuid
+import hashlib
+import shutil
+import tempfile
+import multiprocessing
+import time
+import random
 import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from flask import Flask, request, render_template, redirect, url_for, flash
 from werkzeug.utils import secure_filename
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 import gridfs
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
 from qdrant_client import QdrantClient
 from qdrant_client.http import models as qmodels
-import PyPDF2
+import pypdfium2 as pdfium
+from pdf_text import page_text, extract_page_range
 from dotenv import load_dotenv
 
+import numpy as np
 import requests
+from redis import Redis
+from rq import Queue, get_current_job
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables from .env
 load_dotenv()
 
+class QueryCache:
+    """Thread-safe LRU cache with per-entry TTL for query embeddings."""
+
+    def __init__(self, maxsize=2048, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, model, text):
+        with self._lock:
+            key = (model, text)
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() > expires_at:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, model, text, value):
+        with self._lock:
+            key = (model, text)
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._data.clear()
+
+
+MISTRAL_EMBED_MODEL = "mistral-embed"
+query_embedding_cache = QueryCache()
+
 def get_embeddings(texts):
     return get_mistral_embeddings(texts)
 
-# Connection check for Qdrant and MongoDB
+def get_query_embedding(text):
+    # Search queries repeat often; corpus chunks go through get_embeddings uncached
+    vec = query_embedding_cache.get(MISTRAL_EMBED_MODEL, text)
+    if vec is None:
+        # float32 arrays are ~4 KB per 1024-dim vector vs ~32 KB as a list of floats
+        vec = np.asarray(get_embeddings([text])[0], dtype=np.float32)
+        query_embedding_cache.set(MISTRAL_EMBED_MODEL, text, vec)
+    return vec.tolist()
+
+# Connection check results are reused for this many seconds
+CONNECTION_CHECK_TTL = 10
+_connection_check = (None, (False, False))
+_connection_check_lock = threading.Lock()
+
+# Connection check for Qdrant and MongoDB, cached for CONNECTION_CHECK_TTL seconds
 def check_connections():
+    global _connection_check
+    with _connection_check_lock:
+        last_check, result = _connection_check
+        if last_check is not None and time.monotonic() - last_check <= CONNECTION_CHECK_TTL:
+            return result
+        result = _probe_connections()
+        _connection_check = (time.monotonic(), result)
+        return result
+
+def _probe_connections():
     qdrant_ok = False
     mongo_ok = False
     try:
@@ -42,6 +124,18 @@ def check_connections():
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf', 'txt'}
+# PDFs with at least this many pages are extracted in parallel worker processes.
+# PDFium takes ~1 ms/page and a warm pool ~80 ms to start, so smaller files are faster serially
+PDF_PARALLEL_MIN_PAGES = 200
+# Upper bound on PDF extraction worker processes per upload
+PDF_MAX_WORKERS = 4
+# Workers fork from a clean forkserver that has only pdf_text loaded: no app import per
+# worker, and no forking of a process already running pymongo, gRPC and pool threads
+PDF_MP_CONTEXT = multiprocessing.get_context('forkserver')
+PDF_MP_CONTEXT.set_forkserver_preload(['pdf_text'])
+
+# Shared text splitter, built once at import
+SPLITTER = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
@@ -50,6 +144,7 @@ app.secret_key = os.environ.get('FLASK_SECRET', 'supersecret')
 # Env / clients
 QDRANT_URL = os.environ.get('QDRANT_URL', 'http://localhost:6333')
 QDRANT_API_KEY = os.environ.get('QDRANT_API_KEY')
+QDRANT_GRPC_PORT = int(os.environ.get('QDRANT_GRPC_PORT', 6334))
 MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
 
 mongo = MongoClient(MONGO_URI)
@@ -59,46 +154,267 @@ collections_meta = db['collections_meta']
 # Setup GridFS
 fs = gridfs.GridFS(db)
 
+# Fields the templates need from collection metadata
+COLLECTION_FIELDS = {'name': 1, 'description': 1, 'docs_count': 1, 'created_at': 1, '_id': 0}
+# Cached lists are re-read at least this often
+COLLECTIONS_CACHE_TTL = 30
+# Version counter in Redis, bumped on every metadata write, so all web processes see it
+COLLECTIONS_VERSION_KEY = 'collections_meta:version'
+_cols_cache = (None, None, [])
+_cols_lock = threading.Lock()
+
+def _collections_meta_version():
+    try:
+        return int(redis_conn.get(COLLECTIONS_VERSION_KEY) or 0)
+    except Exception as e:
+        print('redis version read failed:', e)
+        return None
+
+def get_collections_meta():
+    global _cols_cache
+    version = _collections_meta_version()
+    with _cols_lock:
+        cached_version, fetched_at, data = _cols_cache
+        now = time.monotonic()
+        # Without a readable version, fall back to reading Mongo every time
+        if version is not None and cached_version == version and now - fetched_at <= COLLECTIONS_CACHE_TTL:
+            return data
+        data = list(collections_meta.find({}, COLLECTION_FIELDS))
+        _cols_cache = (version, now, data)
+        return data
+
+def invalidate_collections_meta():
+    global _cols_cache
+    try:
+        redis_conn.incr(COLLECTIONS_VERSION_KEY)
+    except Exception as e:
+        print('redis version bump failed:', e)
+        # At least this process stops serving its cached list
+        with _cols_lock:
+            _cols_cache = (None, None, [])
+
+_name_index_ready = False
+
+def ensure_name_index():
+    # Created on first use rather than at import, so a down Mongo doesn't block startup
+    global _name_index_ready
+    if _name_index_ready:
+        return
+    try:
+        collections_meta.create_index('name', unique=True)
+        _name_index_ready = True
+    except Exception as e:
+        print('mongo create index failed:', e)
+
+# Background upload queue (run workers with `rq worker uploads`)
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+# Seconds an upload job may run before RQ kills it
+UPLOAD_JOB_TIMEOUT = 1800
+redis_conn = Redis.from_url(REDIS_URL)
+upload_queue = Queue('uploads', connection=redis_conn)
+
+# Points sent per Qdrant upsert request
+QDRANT_UPSERT_BATCH = 256
+
+# Search the int8 index, then rescore an oversampled candidate set with the original vectors
+QUANTIZED_SEARCH_PARAMS = qmodels.SearchParams(
+    quantization=qmodels.QuantizationSearchParams(rescore=True, oversampling=2.0)
+)
+
 # Qdrant client (cloud cluster)
 qdrant_client = QdrantClient(
     url=QDRANT_URL,
     api_key=QDRANT_API_KEY,
+    # gRPC sends vectors as packed protobuf floats instead of JSON text
+    prefer_grpc=True,
+    grpc_port=QDRANT_GRPC_PORT,
+    timeout=30,
 )
 
 
 # Mistral API endpoint
 MISTRAL_API_URL = "https://api.mistral.ai/v1/embeddings"
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
-
-def get_mistral_embeddings(texts):
-    headers = {
-        "Authorization": f"Bearer {MISTRAL_API_KEY}",
-        "Content-Type": "application/json",
-    }
+# Mistral rejects embedding requests with more inputs than this
+MISTRAL_MAX_BATCH = 64
+# Max sub-batches in flight at once, kept low to stay under rate limits
+MISTRAL_MAX_CONCURRENCY = 4
+
+# Shared keep-alive session so calls skip the TCP/TLS handshake
+mistral_session = requests.Session()
+mistral_session.headers.update({
+    "Authorization": f"Bearer {MISTRAL_API_KEY}",
+    "Content-Type": "application/json",
+})
+# Embedding calls are idempotent, so POSTs are safe to retry on throttling and 5xx
+mistral_session.mount('https://', HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['POST']),
+))
+
+def _post_mistral_batch(batch, jitter=False):
     payload = {
-        "model": "mistral-embed",
-        "input": texts,
+        "model": MISTRAL_EMBED_MODEL,
+        "input": batch,
     }
-    response = requests.post(MISTRAL_API_URL, json=payload, headers=headers)
+    if jitter:
+        # Small jitter so parallel requests don't hit the API in lockstep
+        time.sleep(random.uniform(0, 0.1))
+    response = mistral_session.post(MISTRAL_API_URL, json=payload, timeout=30)
     response.raise_for_status()
     data = response.json()
-    # Return only the embeddings as a list of lists
-    return [item["embedding"] for item in data["data"]]
+    return _normalize_embeddings([item["embedding"] for item in data["data"]])
+
+def _normalize_embeddings(vectors):
+    # L2-normalize once in float32 so cosine collections don't renormalize per point
+    arr = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(arr, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    arr /= norms
+    # Return the embeddings as a list of lists
+    return arr.tolist()
+
+def get_mistral_embeddings(texts):
+    batches = [texts[start:start + MISTRAL_MAX_BATCH] for start in range(0, len(texts), MISTRAL_MAX_BATCH)]
+    if len(batches) <= 1:
+        return _post_mistral_batch(texts) if texts else []
+
+    # Collect into a pre-sized list indexed by batch so input order is kept
+    results = [None] * len(batches)
+    with ThreadPoolExecutor(max_workers=min(MISTRAL_MAX_CONCURRENCY, len(batches))) as ex:
+        futures = {ex.submit(_post_mistral_batch, b, True): i for i, b in enumerate(batches)}
+        for future, i in futures.items():
+            results[i] = future.result()
+    return [vec for batch in results for vec in batch]
 
 # Helpers
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_text_from_pdf(path):
-    text_chunks = []
-    with open(path, 'rb') as f:
-        reader = PyPDF2.PdfReader(f)
-        for p in reader.pages:
-            text = p.extract_text() or ''
-            text_chunks.append(text)
+def extract_text_from_pdf(source):
+    # source may be a file path or a seekable binary file object
+    pdf = pdfium.PdfDocument(source)
+    try:
+        n = len(pdf)
+        workers = min(PDF_MAX_WORKERS, os.cpu_count() or 1, n)
+        # Below this size the pool costs more than PDFium spends on the pages
+        if n < PDF_PARALLEL_MIN_PAGES or workers < 2:
+            return "\n".join(page_text(pdf[i]) for i in range(n))
+    finally:
+        pdf.close()
+
+    # Workers open the PDF by path, so buffers are spilled once to a private temp file
+    # instead of being pickled to every worker
+    tmp_path = None
+    if not isinstance(source, (str, os.PathLike)):
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+            source.seek(0)
+            shutil.copyfileobj(source, tmp)
+            tmp_path = tmp.name
+    path = tmp_path or source
+
+    try:
+        # Give each worker one contiguous page range
+        step = -(-n // workers)
+        ranges = [(path, start, min(start + step, n)) for start in range(0, n, step)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=PDF_MP_CONTEXT) as ex:
+            text_chunks = [text for part in ex.map(extract_page_range, ranges) for text in part]
+    finally:
+        if tmp_path:
+            os.remove(tmp_path)
     return "\n".join(text_chunks)
 
 
+def _set_job_meta(key, value):
+    job = get_current_job()
+    if job is not None:
+        job.meta[key] = value
+        job.save_meta()
+
+def _set_job_progress(progress):
+    _set_job_meta('progress', progress)
+
+def process_upload(file_id, filename, collection_name):
+    """RQ job: extract, embed and index a file stored in GridFS. Returns the chunk count."""
+    try:
+        return _index_upload(file_id, filename, collection_name)
+    except Exception as e:
+        # Surface the reason on the status page, then undo partial indexing. docs_count is
+        # only incremented on success, so removing this upload's points keeps them in step
+        _set_job_meta('error', str(e))
+        try:
+            # Ordered after any wait=False upserts already queued on the collection
+            qdrant_client.delete(
+                collection_name=collection_name,
+                points_selector=qmodels.FilterSelector(
+                    filter=qmodels.Filter(must=[
+                        qmodels.FieldCondition(key='upload_id', match=qmodels.MatchValue(value=str(file_id)))
+                    ])
+                ),
+                wait=True,
+            )
+        except Exception as cleanup_error:
+            # Keep the file so the leftover points still have a source to match
+            print('qdrant cleanup failed, keeping gridfs file', file_id, cleanup_error)
+            raise e
+        try:
+            fs.delete(file_id)
+        except Exception as delete_error:
+            print('gridfs delete failed:', delete_error)
+        raise
+
+def _index_upload(file_id, filename, collection_name):
+    _set_job_progress('extracting')
+    # Stream file back from GridFS in 1 MiB chunks
+    grid_out = fs.get(file_id)
+    buf = io.BytesIO()
+    for chunk in iter(lambda: grid_out.read(1 << 20), b""):
+        buf.write(chunk)
+    buf.seek(0)
+
+    # Extract text depending on file type
+    if filename.lower().endswith('.pdf'):
+        text = extract_text_from_pdf(buf)
+    else:
+        text = buf.getvalue().decode('utf-8')
+
+    if not text.strip():
+        raise ValueError('No text extracted from file')
+
+    documents = SPLITTER.split_documents([Document(page_content=text, metadata={'source': filename})])
+
+    _set_job_progress(f'embedding {len(documents)} chunks')
+    # Embed each distinct chunk once (repeated headers, footers, TOC) and share the vector
+    seen = {}
+    uniq_texts = []
+    idx = []
+    for d in documents:
+        h = hashlib.blake2b(d.page_content.encode('utf-8'), digest_size=16).digest()
+        if h not in seen:
+            seen[h] = len(uniq_texts)
+            uniq_texts.append(d.page_content)
+        idx.append(seen[h])
+    uniq_vectors = get_embeddings(uniq_texts)
+    vectors = [uniq_vectors[i] for i in idx]
+
+    points = []
+    for i, vec in enumerate(vectors):
+        payload = documents[i].metadata.copy()
+        payload.update({'collection': collection_name, 'chunk': documents[i].page_content, 'page_content': documents[i].page_content, 'chunk_index': i, 'upload_id': str(file_id)})
+        points.append(qmodels.PointStruct(id=str(uuid.uuid4()), vector=vec, payload=payload))
+
+    # Upsert in batches without waiting for indexing; Qdrant indexes in the background
+    for start in range(0, len(points), QDRANT_UPSERT_BATCH):
+        _set_job_progress(f'indexing {start}/{len(points)} chunks')
+        qdrant_client.upsert(collection_name=collection_name, points=points[start:start + QDRANT_UPSERT_BATCH], wait=False)
+
+    collections_meta.update_one({'name': collection_name}, {'$inc': {'docs_count': len(documents)}})
+    invalidate_collections_meta()
+    _set_job_progress('done')
+    return len(documents)
+
+
 @app.route('/clear_collection/<collection_name>', methods=['POST'])
 def clear_collection(collection_name):
     try:
@@ -110,6 +426,8 @@ def clear_collection(collection_name):
             )
         )
         collections_meta.update_one({'name': collection_name}, {'$set': {'docs_count': 0}})
+        invalidate_collections_meta()
+        query_embedding_cache.invalidate()
         flash(f'Cleared all data in collection {collection_name}', 'success')
     except Exception as e:
         flash(f'Failed to clear collection: {e}', 'danger')
@@ -117,7 +435,7 @@ def clear_collection(collection_name):
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    cols = list(collections_meta.find({}))
+    cols = get_collections_meta()
     search_results = None
     search_query = None
     selected_collection = None
@@ -134,34 +452,40 @@ def index():
         search_query = request.form.get('search_query')
         selected_collection = request.form.get('search_collection')
         if search_query and selected_collection:
-            query_vec = get_embeddings([search_query])[0]
+            query_vec = get_query_embedding(search_query)
             try:
                 if selected_collection == "__all__":
-                    # Search all collections
-                    search_results = []
-                    for c in cols:
+                    # Search all collections in parallel
+                    def search_one(c):
                         try:
-                            result = qdrant_client.search(
+                            return c, qdrant_client.search(
                                 collection_name=c['name'],
                                 query_vector=query_vec,
-                                limit=5
+                                limit=5,
+                                search_params=QUANTIZED_SEARCH_PARAMS,
                             )
-                            for r in result:
-                                search_results.append({
-                                    'score': r.score,
-                                    'source': r.payload.get('source', 'N/A'),
-                                    'collection': r.payload.get('collection', c['name']),
-                                    'chunk': r.payload.get('chunk') or r.payload.get('page_content', 'N/A'),
-                                })
-                        except Exception as e:
-                            continue
+                        except Exception:
+                            return c, []
+
+                    search_results = []
+                    if cols:
+                        with ThreadPoolExecutor(max_workers=min(16, len(cols))) as ex:
+                            for c, result in ex.map(search_one, cols):
+                                for r in result:
+                                    search_results.append({
+                                        'score': r.score,
+                                        'source': r.payload.get('source', 'N/A'),
+                                        'collection': r.payload.get('collection', c['name']),
+                                        'chunk': r.payload.get('chunk') or r.payload.get('page_content', 'N/A'),
+                                    })
                     # Sort by score descending
                     search_results = sorted(search_results, key=lambda x: x['score'], reverse=True)[:10]
                 else:
                     result = qdrant_client.search(
                         collection_name=selected_collection,
                         query_vector=query_vec,
-                        limit=10
+                        limit=10,
+                        search_params=QUANTIZED_SEARCH_PARAMS,
                     )
                     search_results = [
                         {
@@ -177,7 +501,7 @@ def index():
 
 @app.route('/collections')
 def list_collections():
-    cols = list(collections_meta.find({}))
+    cols = get_collections_meta()
     return render_template('collections.html', collections=cols)
 
 @app.route('/create_collection', methods=['POST'])
@@ -200,12 +524,25 @@ def create_collection():
         'created_at': datetime.datetime.utcnow(),
         'docs_count': 0
     }
-    collections_meta.insert_one(meta)
+    ensure_name_index()
+    try:
+        collections_meta.insert_one(meta)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent create of the same name
+        flash('Collection already exists', 'warning')
+        return redirect(url_for('index'))
+    invalidate_collections_meta()
 
     try:
         qdrant_client.recreate_collection(
             collection_name=name,
-            vectors_config=qmodels.VectorParams(size=1024, distance=qmodels.Distance.COSINE),
+            # Full-precision vectors live on disk and are only read to rescore
+            vectors_config=qmodels.VectorParams(size=1024, distance=qmodels.Distance.COSINE, on_disk=True),
+            # int8 scalar quantization keeps a 4x smaller copy of vectors in RAM for search
+            quantization_config=qmodels.ScalarQuantization(
+                scalar=qmodels.ScalarQuantizationConfig(type=qmodels.ScalarType.INT8, quantile=0.99, always_ram=True)
+            ),
+            hnsw_config=qmodels.HnswConfigDiff(m=32, ef_construct=256),
         )
     except Exception as e:
         print('qdrant create collection failed:', e)
@@ -215,7 +552,7 @@ def create_collection():
 
 @app.route('/upload', methods=['GET', 'POST'])
 def upload():
-    cols = list(collections_meta.find({}))
+    cols = get_collections_meta()
     if request.method == 'GET':
         return render_template('upload.html', collections=cols)
 
@@ -234,52 +571,41 @@ def upload():
 
     filename = secure_filename(file.filename)
 
-    # Save file in MongoDB GridFS
+    # Save file in MongoDB GridFS; the worker reads it back from there
     file_id = fs.put(file, filename=filename, collection=collection_name)
 
+    # Extraction, embedding and indexing run in an RQ worker. Enqueue by dotted path:
+    # under `python app.py` this module is __main__, which workers can't import
+    job = upload_queue.enqueue('app.process_upload', file_id, filename, collection_name, job_timeout=UPLOAD_JOB_TIMEOUT)
 
-    # Read file back from GridFS
-    grid_out = fs.get(file_id)
-    content = grid_out.read()
-
-    # Extract text depending on file type
-    if filename.lower().endswith('.pdf'):
-        with open("temp.pdf", "wb") as temp:
-            temp.write(content)
-        text = extract_text_from_pdf("temp.pdf")
-        os.remove("temp.pdf")
-    else:
-        text = content.decode('utf-8')
+    flash(f'Queued {filename} for indexing into collection {collection_name}', 'info')
+    return redirect(url_for('upload_status', job_id=job.id))
 
-    if not text.strip():
-        flash('No text extracted from file', 'warning')
+@app.route('/upload_status/<job_id>')
+def upload_status(job_id):
+    try:
+        job = Job.fetch(job_id, connection=redis_conn)
+    except NoSuchJobError:
+        flash('Upload job not found', 'danger')
         return redirect(url_for('upload'))
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    docs = splitter.split_text(text)
-    documents = [Document(page_content=t, metadata={'source': filename}) for t in docs]
+    status = job.get_status()
+    if status == 'finished':
+        query_embedding_cache.invalidate()
+    return render_template('upload_status.html', job=job, status=status, progress=job.meta.get('progress'))
 
-    vectors = get_embeddings([d.page_content for d in documents])
-
-    points = []
-    for i, vec in enumerate(vectors):
-        payload = documents[i].metadata.copy()
-        payload.update({'collection': collection_name, 'chunk': documents[i].page_content, 'page_content': documents[i].page_content})
-        points.append(qmodels.PointStruct(id=i, vector=vec, payload=payload))
-
-    qdrant_client.upsert(collection_name=collection_name, points=points)
-
-    collections_meta.update_one({'name': collection_name}, {'$inc': {'docs_count': len(documents)}})
-
-    flash(f'Uploaded and indexed {len(documents)} chunks to collection {collection_name}', 'success')
-    return redirect(url_for('index'))
-
-    query_vec = get_embeddings([search_query])[0]
+@app.route('/view_collection/<collection_name>')
 def view_collection(collection_name):
     meta = collections_meta.find_one({'name': collection_name})
     try:
-        resp = qdrant_client.scroll(collection_name=collection_name, limit=20)
-        points = [{'id': p.id, 'payload': p.payload} for p in resp.points]
+        # Only payload fields the page renders; vectors are never shown
+        records, _ = qdrant_client.scroll(
+            collection_name=collection_name,
+            limit=20,
+            with_vectors=False,
+            with_payload=qmodels.PayloadSelectorInclude(include=['source', 'collection']),
+        )
+        points = [{'id': p.id, 'payload': p.payload} for p in records]
     except Exception as e:
         print('qdrant scroll error', e)
         points = []
@@ -0,0 +1,21 @@
+# PDF page text helpers. Kept free of app imports so spawned extraction
+# workers only load pypdfium2, not Flask, the DB clients or langchain.
+
+import pypdfium2 as pdfium
+
+
+def page_text(page):
+    textpage = page.get_textpage()
+    text = textpage.get_text_range()
+    textpage.close()
+    page.close()
+    return text
+
+def extract_page_range(args):
+    # Runs in a worker process; each worker opens its own document handle
+    path, start, stop = args
+    pdf = pdfium.PdfDocument(path)
+    try:
+        return [page_text(pdf[i]) for i in range(start, stop)]
+    finally:
+        pdf.close()